@@ -2,34 +2,330 @@ import os
 import time
 import logging
 import shutil
+import json
+import hashlib
+import queue
+import asyncio
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+import numpy as np
+import httpx
+import orjson
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dotenv import load_dotenv
-from langchain_community.document_loaders import DirectoryLoader, UnstructuredMarkdownLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from pydantic import PrivateAttr
+from semantic_text_splitter import TextSplitter
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_ollama import OllamaEmbeddings
 from langchain_community.vectorstores import Chroma
 from tqdm import tqdm
+from mmap_store import MmapVectorStore, deleteStore
 
-# Load the .env file here
-load_dotenv(override=True)
+# Fallbacks and limits that aren't read from the .env
+DEFAULT_OLLAMA_BASE_URL = "http://localhost:11434"                         # where the ollama server usually lives
+DEFAULT_TEI_BASE_URL = "http://localhost:8080"                             # where the text-embeddings-inference server usually lives
+MAX_EMBEDDING_DIM = 2048                                                   # warn above this, a chat model is probably being used to embed
+MANIFEST_NAME = "manifest.json"                                            # per-file hashes from the last ingest, kept inside chromaPath
+MANIFEST_VERSION = 2                                                       # bumped when chunk ids or the manifest layout change
 
-# Config vars from the .env files
-VAULT_PATH = os.getenv("OBSIDIAN_VAULT_PATH")               # path to osidian vault
-CHROMA_PATH = os.getenv("CHROMA_DB_PATH")                   # path to the chromadb directory
-EMBEDDING_MODEL = os.getenv("OLLAMA_EMBEDDING_MODEL")       # name of model to embed (ollama)
+@dataclass(frozen=True)
+class Config:
+    """
+    Settings for an ingest run, read from the .env file by Config.load()
+
+    Nothing is read when the module is imported, so helpers like printDirectory can be
+    reused (and the module imported by tests or other scripts) without a .env file.
+    """
+
+    vaultPath: str                  # path to obsidian vault
+    chromaPath: str                 # path to the chromadb directory, also holds the manifest and the mmap store
+    embeddingModel: str | None      # name of model to embed (ollama)
+    embeddingBackend: str           # "ollama" or "tei"
+    teiBaseUrl: str                 # where the text-embeddings-inference server lives
+    ollamaBaseUrl: str              # where the ollama server lives
+    embedBatchSize: int             # texts per embed request
+    numParallel: int                # embed requests in flight at once
+    keepAlive: int | str            # how long ollama keeps the model loaded after a request
+    writeBatchSize: int             # chunks embedded and written to the store per step
+    chunkTokenizer: str | None      # optional hugging face tokenizer, chunks by tokens instead of characters
+    chunkTokens: int                # tokens per chunk when chunkTokenizer is set
+    chunkTokenOverlap: int          # tokens shared by neighbouring chunks
+    quantization: str               # "none" or "int8", int8 needs the mmap backend
+    vectorBackend: str              # "chroma" or "mmap", both live in chromaPath
+    pipelineQueueSize: int          # items each ingest stage may run ahead of the next
+    minChunkChars: int              # shorter chunks (after stripping whitespace) are not embedded
+
+    @classmethod
+    def load(cls) -> "Config":
+        """
+        Load the .env file and build a Config from it, raising ValueError on missing or bad values
+        """
+        # Load the .env file here
+        load_dotenv(override=True)
+
+        # Plain numbers (seconds, or -1 for forever) have to reach ollama as JSON numbers, it only
+        # parses strings as durations with a unit like "30m"
+        keepAlive = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+        try:
+            keepAlive = int(keepAlive)
+        except ValueError:
+            pass
+        config = cls(
+            vaultPath=os.getenv("OBSIDIAN_VAULT_PATH"),
+            chromaPath=os.getenv("CHROMA_DB_PATH"),
+            embeddingModel=os.getenv("OLLAMA_EMBEDDING_MODEL"),
+            embeddingBackend=os.getenv("EMBEDDING_BACKEND", "ollama").lower(),
+            teiBaseUrl=os.getenv("TEI_BASE_URL", DEFAULT_TEI_BASE_URL),
+            ollamaBaseUrl=os.getenv("OLLAMA_BASE_URL", DEFAULT_OLLAMA_BASE_URL),
+            embedBatchSize=int(os.getenv("EMBED_BATCH_SIZE", "32")),
+            numParallel=int(os.getenv("OLLAMA_NUM_PARALLEL", "1")),
+            keepAlive=keepAlive,
+            writeBatchSize=int(os.getenv("WRITE_BATCH_SIZE", "256")),
+            chunkTokenizer=os.getenv("CHUNK_TOKENIZER"),
+            chunkTokens=int(os.getenv("CHUNK_TOKENS", "512")),
+            chunkTokenOverlap=int(os.getenv("CHUNK_TOKEN_OVERLAP", "64")),
+            quantization=os.getenv("EMBEDDING_QUANTIZATION", "none").lower(),
+            vectorBackend=os.getenv("VECTOR_BACKEND", "chroma").lower(),
+            pipelineQueueSize=int(os.getenv("PIPELINE_QUEUE_SIZE", "64")),
+            minChunkChars=int(os.getenv("MIN_CHUNK_CHARS", "50"))
+        )
+
+        # Raise errors if .env fails to contain files
+        if not config.vaultPath:
+            raise ValueError("Error. OBSIDIAN_VAULT_PATH variable expected in .env file. Not found.")
+        if not config.chromaPath:
+            raise ValueError("Error. CHROMA_DB_PATH variable expected in .env file. Not found.")
+        if config.embeddingBackend not in ("ollama", "tei"):
+            raise ValueError(f"Error. EMBEDDING_BACKEND must be 'ollama' or 'tei'. Found: {config.embeddingBackend}")
+        if config.quantization not in ("none", "int8"):
+            raise ValueError(f"Error. EMBEDDING_QUANTIZATION must be 'none' or 'int8'. Found: {config.quantization}")
+        if config.vectorBackend not in ("chroma", "mmap"):
+            raise ValueError(f"Error. VECTOR_BACKEND must be 'chroma' or 'mmap'. Found: {config.vectorBackend}")
+        if config.quantization == "int8" and config.vectorBackend != "mmap":
+            # chroma's index keeps float32 no matter what it is given, int8 there only loses precision
+            raise ValueError("Error. EMBEDDING_QUANTIZATION=int8 needs VECTOR_BACKEND=mmap, chroma always stores float32.")
+        if config.embeddingBackend == "ollama" and not config.embeddingModel:
+            raise ValueError("Error. OLLAMA_EMBEDDING_MODEL variable expected in .env file. Not found.")
+        if config.chunkTokenizer and config.chunkTokenOverlap >= config.chunkTokens:
+            raise ValueError(f"Error. CHUNK_TOKEN_OVERLAP ({config.chunkTokenOverlap}) must be smaller than CHUNK_TOKENS ({config.chunkTokens}).")
+        return config
+
+async def embedInBatches(texts: list[str], batchSize: int, numParallel: int, embedBatch, out: np.ndarray = None):
+    """
+    Helper function to embed texts in fixed size batches, with up to numParallel batches in flight
+
+    All requests are coroutines on one event loop, so waiting on the server costs no threads.
+    Returns a list with one vector per text, or fills and returns out if it is given.
+
+    Args:
+        texts (list[str]): texts to embed
+        batchSize (int): number of texts handed to embedBatch at once
+        numParallel (int): number of batches in flight at once
+        embedBatch (coroutine function): embeds one list of texts, returns one vector per text
+        out (np.ndarray): optional preallocated (len(texts), dim) array to write the vectors into
+    """
+    semaphore = asyncio.Semaphore(max(numParallel, 1))
+
+    async def embedBounded(start: int) -> list[list[float]]:
+        async with semaphore:
+            vectors = await embedBatch(texts[start:start + batchSize])
+        if out is None:
+            return vectors
+        # copy each batch into place as soon as it arrives, so no list of every vector builds up
+        out[start:start + len(vectors)] = vectors
+        return None
+
+    # gather hands results back in submission order, so vectors line up with texts
+    results = await asyncio.gather(*(embedBounded(start) for start in range(0, len(texts), batchSize)))
+    if out is not None:
+        return out
+    return [vector for batch in results for vector in batch]
+
+def makeHttpClient(baseUrl: str, poolSize: int) -> httpx.AsyncClient:
+    """
+    Helper function to build a keep-alive async http client with a connection pool of poolSize
+
+    Connections are reused across requests instead of being set up per call. HTTP/2 is
+    negotiated when the server offers it (e.g. a remote server behind TLS), in which case
+    concurrent requests share a single connection.
+
+    Args:
+        baseUrl (str): server every request goes to
+        poolSize (int): number of connections to keep open, should match the requests in flight
+    """
+    poolSize = max(poolSize, 1)
+    return httpx.AsyncClient(
+        base_url=baseUrl,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=poolSize, max_connections=poolSize),
+        timeout=60
+    )
+
+class AsyncClientMixin(ABC):
+    """
+    Embeds in batches on the client's own event loop with one keep-alive http client
+
+    The loop and client are created on first use and live until close(), so connections
+    survive between calls. Subclasses provide batch_size, num_parallel, and _httpClient and
+    _loop attributes (None until used). The sync methods must not be called from several
+    threads at once.
+    """
+
+    @abstractmethod
+    def _newHttpClient(self) -> httpx.AsyncClient:
+        """
+        Build the http client requests go through, see makeHttpClient
+        """
+
+    @abstractmethod
+    async def _embedBatch(self, batch: list[str]) -> list[list[float]]:
+        """
+        Send one batch of texts to the server, returns one vector per text
+        """
+
+    @abstractmethod
+    def modelId(self) -> str:
+        """
+        Name of the model the vectors come from
+        """
+
+    def _runAsync(self, coroutine):
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._httpClient = self._newHttpClient()
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return self._loop.run_until_complete(coroutine)
+        # Called from inside a running event loop (e.g. a notebook), which can't nest
+        # run_until_complete, so drive the private loop from a helper thread instead
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(self._loop.run_until_complete, coroutine).result()
+
+    def close(self):
+        """
+        Close the http client and the event loop, a later call opens new ones
+        """
+        if self._loop is None:
+            return
+        self._runAsync(self._httpClient.aclose())
+        self._loop.close()
+        self._loop = None
+        self._httpClient = None
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._runAsync(embedInBatches(texts, self.batch_size, self.num_parallel, self._embedBatch))
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    def embedArray(self, texts: list[str], dimension: int) -> np.ndarray:
+        """
+        Embed texts straight into a (len(texts), dimension) float32 array
+        """
+        out = np.empty((len(texts), dimension), dtype=np.float32)
+        return self._runAsync(embedInBatches(texts, self.batch_size, self.num_parallel, self._embedBatch, out))
+
+class BatchedOllamaEmbeddings(AsyncClientMixin, OllamaEmbeddings):
+    """
+    OllamaEmbeddings that sends texts to /api/embed in fixed size batches
+
+    Every batch is one HTTP request on a shared keep-alive client, so the number of
+    round trips to the server is len(texts) / batch_size instead of one per chunk.
+    Up to num_parallel batches are in flight at once, which only helps if the server
+    was started with OLLAMA_NUM_PARALLEL set at least that high. Requests run on this
+    object's own event loop, see AsyncClientMixin.
+    """
+
+    batch_size: int = 32
+    num_parallel: int = 1
+    keep_alive: int | str | None = None  # ollama also takes durations like "30m"
+    _httpClient: httpx.AsyncClient = PrivateAttr(default=None)
+    _loop: asyncio.AbstractEventLoop = PrivateAttr(default=None)
+
+    def _newHttpClient(self) -> httpx.AsyncClient:
+        return makeHttpClient(self.base_url or DEFAULT_OLLAMA_BASE_URL, self.num_parallel)
+
+    def modelId(self) -> str:
+        return self.model
+
+    async def _embedBatch(self, batch: list[str]) -> list[list[float]]:
+        payload = {
+            "model": self.model,
+            "input": batch,
+            "options": {k: v for k, v in self._default_params.items() if v is not None},
+        }
+        if self.dimensions is not None:
+            payload["dimensions"] = self.dimensions
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        response = await self._httpClient.post("/api/embed", json=payload)
+        response.raise_for_status()
+        # neither ollama nor TEI can send raw float32, so parse the JSON with orjson,
+        # which is several times faster than response.json() on thousands of floats per chunk
+        return orjson.loads(response.content)["embeddings"]
+
+class TeiEmbeddings(AsyncClientMixin, Embeddings):
+    """
+    Embeddings client for a Hugging Face text-embeddings-inference (TEI) server
+
+    TEI batches and runs the model itself, so this only has to POST lists of texts to
+    /embed. The model is picked when the server is started, not here. Keep batch_size
+    at or below the server's --max-client-batch-size or it will reject the request.
+    Requests run on this object's own event loop, see AsyncClientMixin.
+    """
+
+    def __init__(self, base_url: str = DEFAULT_TEI_BASE_URL, batch_size: int = 32, num_parallel: int = 1):
+        self.base_url = base_url
+        self.batch_size = batch_size
+        self.num_parallel = num_parallel
+        self._loop = None
+        self._httpClient = None
 
-# Raise errors if .env fails to contain files
-if not VAULT_PATH:
-    raise ValueError("Error. OBSIDIAN_VAULT_PATH variable expected in .env file. Not found.")
-if not CHROMA_PATH:
-    raise ValueError("Error. CHROMA_DB_PATH variable expected in .env file. Not found.")
-if not EMBEDDING_MODEL:
-    raise ValueError("Error. OLLAMA_EMBEDDING_MODEL variable expected in .env file. Not found.")
+    def _newHttpClient(self) -> httpx.AsyncClient:
+        return makeHttpClient(self.base_url, self.num_parallel)
+
+    async def _fetchModelId(self) -> str:
+        response = await self._httpClient.get("/info")
+        response.raise_for_status()
+        return orjson.loads(response.content)["model_id"]
+
+    def modelId(self) -> str:
+        # the model is picked by the server's --model-id, so ask the server
+        return self._runAsync(self._fetchModelId())
+
+    async def _embedBatch(self, batch: list[str]) -> list[list[float]]:
+        response = await self._httpClient.post("/embed", json={"inputs": batch})
+        response.raise_for_status()
+        return orjson.loads(response.content)
+
+def getEmbeddings(config: Config) -> BatchedOllamaEmbeddings | TeiEmbeddings:
+    """
+    Helper function to build the embeddings client picked by config.embeddingBackend
+
+    Args:
+        config (Config): settings for this run
+    """
+    if config.embeddingBackend == "tei":
+        return TeiEmbeddings(base_url=config.teiBaseUrl, batch_size=config.embedBatchSize, num_parallel=config.numParallel)
+    return BatchedOllamaEmbeddings(
+        model=config.embeddingModel,
+        base_url=config.ollamaBaseUrl,
+        batch_size=config.embedBatchSize,
+        num_parallel=config.numParallel,
+        keep_alive=config.keepAlive
+    )
 
 # function to print out contents of a file directory
 def printDirectory(path : str, printOnlyMd : bool = False):
     """
     Helper function to print contents of a directory
 
+    The walk also collects every *.md path, which is returned so callers don't have to
+    walk the directory a second time.
+
     Args:
         path (str): directory to search
         printOnlyMd (bool): if True, print only *.md file, else print all files
@@ -40,7 +336,7 @@ def printDirectory(path : str, printOnlyMd : bool = False):
     print(f"Mode: {'Only *.md Files' if printOnlyMd else 'All Files'}")
 
     totalFiles = 0
-    mdFiles = 0
+    mdPaths = []
     files = []
 
     for dirpath, _, filenames in os.walk(path):
@@ -48,20 +344,450 @@ def printDirectory(path : str, printOnlyMd : bool = False):
             totalFiles += 1
             filePath = os.path.join(dirpath, filename)
             if(filename.endswith('.md')):
-                mdFiles += 1
-                if printOnlyMd:
-                    files.append(filePath)
+                mdPaths.append(filePath)
             if not printOnlyMd:
                 files.append(filePath)
+    if printOnlyMd:
+        files = mdPaths
     
     for f in files:
         print(f"\t  -> Found: {f}")
 
     print(f"\nSummary:")
-    print(f"\tTotal Markdown Files found: {mdFiles}")
+    print(f"\tTotal Markdown Files found: {len(mdPaths)}")
     print(f"\tTotal Overall Files found {totalFiles}")
     print(f"--- Finished Printing Directory ---\n")
-    return
+    return mdPaths
+
+def loadMarkdown(path: str) -> Document:
+    """
+    Helper function to read a markdown file into a Document as plain text
+
+    Obsidian notes are plain markdown, so a single read() is enough. The unstructured
+    library's parsing pipeline costs far more and doesn't improve the embeddings.
+
+    Args:
+        path (str): markdown file to read
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return Document(page_content=f.read(), metadata={"source": path})
+
+def loadTokenizer(tokenizerName: str):
+    """
+    Helper function to load a fast (rust) hugging face tokenizer for token chunking
+
+    Args:
+        tokenizerName (str): hugging face id of the tokenizer, ideally the embedding model's own
+    """
+    # transformers is only needed for token chunking, so it isn't a hard requirement
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(tokenizerName, use_fast=True)
+
+def splitByTokens(documents: list[Document], tokenizer, chunkSize: int, chunkOverlap: int) -> list[list[str]]:
+    """
+    Helper function to split documents into windows of chunkSize tokens, returns the chunk texts of each document
+
+    Every document is tokenized exactly once, in a single batched call to the fast (rust)
+    tokenizer. The character offsets it returns are used to slice each window straight out
+    of the original text, so nothing is re-tokenized while splitting.
+
+    Args:
+        documents (list[Document]): documents to split
+        tokenizer: fast tokenizer from loadTokenizer
+        chunkSize (int): tokens per chunk
+        chunkOverlap (int): tokens shared by neighbouring chunks, smaller than chunkSize (checked by Config.load)
+    """
+    encodings = tokenizer(
+        [doc.page_content for doc in documents],
+        add_special_tokens=False,
+        return_offsets_mapping=True
+    )
+
+    chunksPerDocument = []
+    step = chunkSize - chunkOverlap
+    for doc, offsets in zip(documents, encodings["offset_mapping"]):
+        chunks = []
+        for start in range(0, len(offsets), step):
+            end = min(start + chunkSize, len(offsets))
+            chunks.append(doc.page_content[offsets[start][0]:offsets[end - 1][1]])
+            if end == len(offsets):
+                break
+        chunksPerDocument.append(chunks)
+    return chunksPerDocument
+
+def hashFile(path: str) -> str:
+    """
+    Helper function to get the sha256 hex digest of a file's contents
+
+    Args:
+        path (str): file to hash
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def manifestSettings(config: Config, modelId: str) -> dict:
+    """
+    Helper function to collect the settings a manifest is only valid for
+
+    The manifest lives next to both vector stores, so it has to say which store, quantization
+    and model it describes. A manifest written with other settings says nothing about this store.
+    The vector dimension is only known after the warmup call, main() adds it as "dimension".
+
+    Args:
+        config (Config): settings for this run
+        modelId (str): model the embeddings client reports, see AsyncClientMixin.modelId
+    """
+    return {
+        "manifestVersion": MANIFEST_VERSION,
+        "vectorBackend": config.vectorBackend,
+        "quantization": config.quantization,
+        "embeddingBackend": config.embeddingBackend,
+        "embeddingModel": modelId
+    }
+
+def loadManifest(path: str) -> dict:
+    """
+    Helper function to read the manifest written by the last ingest, empty if there is none
+
+    Args:
+        path (str): manifest file location
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def saveManifest(path: str, manifest: dict):
+    """
+    Helper function to write the manifest for the next ingest to compare against
+
+    Args:
+        path (str): manifest file location
+        manifest (dict): {"settings": dict from manifestSettings,
+                          "files": {source path: {"mtime": float, "sha256": str, "chunks": [chunk ids]}}}
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+def diffVault(mdPaths: list[str], manifest: dict):
+    """
+    Helper function to compare the vault against the last manifest
+
+    Files whose mtime hasn't moved are trusted without being re-hashed. Returns the
+    paths that are new or changed, the paths that were deleted, and the new manifest.
+
+    Args:
+        mdPaths (list[str]): every markdown file currently in the vault
+        manifest (dict): per-file entries ("files") of the manifest from the last ingest
+    """
+    changedPaths = []
+    newManifest = {}
+    for path in mdPaths:
+        mtime = os.path.getmtime(path)
+        previous = manifest.get(path)
+        if previous and previous["mtime"] == mtime:
+            newManifest[path] = previous
+            continue
+        sha = hashFile(path)
+        newManifest[path] = {"mtime": mtime, "sha256": sha}
+        if not previous or previous["sha256"] != sha:
+            changedPaths.append(path)
+    deletedPaths = [path for path in manifest if path not in newManifest]
+    return changedPaths, deletedPaths, newManifest
+
+def chunkId(text: str) -> str:
+    """
+    Helper function to build the id of a chunk from its text
+
+    Rows are keyed by content, so a chunk that shows up in several notes (a repeated template
+    fragment) is embedded and stored once, and an edited chunk gets a new id. Which notes use
+    a row is kept in the manifest, see pruneChunks.
+
+    Args:
+        text (str): text of the chunk
+    """
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+def checkEmbeddingDimension(embeddings: Embeddings) -> int:
+    """
+    Helper function to send one test text through the embeddings and check the vector size
+
+    Purpose-built embedders return 384-1024 dims. Anything at MAX_EMBEDDING_DIM or above is
+    usually a chat model, which is slower to run and makes the chroma index several times bigger.
+
+    Args:
+        embeddings (Embeddings): embeddings client about to be used for ingest
+    """
+    dimension = len(embeddings.embed_query("dimension check"))
+    if dimension >= MAX_EMBEDDING_DIM:
+        print(f"Warning: embedding model returns {dimension} dimensions. "
+              f"A dedicated embedding model such as nomic-embed-text (768) will be much faster and smaller.")
+    else:
+        print(f"Embedding model returns {dimension} dimensions")
+    return dimension
+
+# Sentinel a pipeline stage passes downstream once it has no more items
+PIPELINE_DONE = object()
+
+def putUnlessStopped(q: queue.Queue, item, stopEvent: threading.Event) -> bool:
+    """
+    Helper function to put onto a bounded queue, giving up if the pipeline was stopped
+
+    Args:
+        q (queue.Queue): queue feeding the next stage
+        item: item to hand over
+        stopEvent (threading.Event): set when any stage fails
+    """
+    while not stopEvent.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def getUnlessStopped(q: queue.Queue, stopEvent: threading.Event):
+    """
+    Helper function to take from a queue, returns PIPELINE_DONE if the pipeline was stopped
+
+    Args:
+        q (queue.Queue): queue fed by the previous stage
+        stopEvent (threading.Event): set when any stage fails
+    """
+    while not stopEvent.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return PIPELINE_DONE
+
+def runStage(stage, outQueue: queue.Queue, stopEvent: threading.Event, errors: list):
+    """
+    Helper function to run one pipeline stage on its own thread
+
+    A failing stage records its exception and stops the whole pipeline. Either way the
+    next stage is told that nothing more is coming.
+
+    Args:
+        stage (callable): the stage's work, takes no arguments
+        outQueue (queue.Queue): queue feeding the next stage
+        stopEvent (threading.Event): set when any stage fails
+        errors (list): exceptions raised by stages
+    """
+    try:
+        stage()
+    except BaseException as e:
+        errors.append(e)
+        stopEvent.set()
+    finally:
+        putUnlessStopped(outQueue, PIPELINE_DONE, stopEvent)
+
+def filterChunks(chunks: list[str], minChars: int) -> list[str]:
+    """
+    Helper function to drop chunks that aren't worth embedding, returns the rest
+
+    Leftover headers and empty front matter under minChars are dropped. Repeated chunks are
+    kept here, they share one row through their content id (see chunkId).
+
+    Args:
+        chunks (list[str]): chunk texts of one document
+        minChars (int): shortest chunk worth embedding, after stripping whitespace
+    """
+    return [text for text in chunks if len(text.strip()) >= minChars]
+
+def existingChunkIds(vectorStore: Chroma | MmapVectorStore, ids: list[str]) -> set:
+    """
+    Helper function to find which of these chunk ids are already in the vector store
+
+    Args:
+        vectorStore (Chroma | MmapVectorStore): store to look in
+        ids (list[str]): chunk ids to look up
+    """
+    if isinstance(vectorStore, MmapVectorStore):
+        return vectorStore.existingIds(ids)
+    return set(vectorStore._collection.get(ids=ids, include=[])["ids"])
+
+def pruneChunks(vectorStore: Chroma | MmapVectorStore, files: dict, candidateIds: set):
+    """
+    Helper function to delete the rows no note uses any more, out of the rows some notes stopped using
+
+    A row can be shared by several notes, so it only goes once no note in the manifest lists its
+    id. A surviving row is pointed at a note that still uses it, its old source may be gone.
+
+    Args:
+        vectorStore (Chroma | MmapVectorStore): store to prune
+        files (dict): per-file entries of the new manifest, with the chunk ids each note uses
+        candidateIds (set): ids that changed or deleted notes used before this run
+    """
+    owners = {}
+    for path in sorted(files):
+        for chunk in files[path].get("chunks", []):
+            if chunk in candidateIds:
+                owners.setdefault(chunk, path)
+    staleIds = [chunk for chunk in candidateIds if chunk not in owners]
+
+    if isinstance(vectorStore, MmapVectorStore):
+        vectorStore.deleteIds(staleIds)
+        vectorStore.updateMetadata({chunk: {"source": path} for chunk, path in owners.items()})
+        return
+    step = vectorStore._client.get_max_batch_size()
+    for start in range(0, len(staleIds), step):
+        vectorStore._collection.delete(ids=staleIds[start:start + step])
+    ownedIds = list(owners)
+    for start in range(0, len(ownedIds), step):
+        batch = ownedIds[start:start + step]
+        vectorStore._collection.update(ids=batch, metadatas=[{"source": owners[chunk]} for chunk in batch])
+
+def writeBatch(vectorStore: Chroma | MmapVectorStore, embeddings: BatchedOllamaEmbeddings | TeiEmbeddings, dimension: int, texts: list[str], metadatas: list[dict], ids: list[str]) -> int:
+    """
+    Helper function to embed one batch of chunks and upsert it into the vector store
+
+    Chunks whose id is already stored are skipped without being embedded. Returns the number
+    of chunks that were embedded.
+
+    Args:
+        vectorStore (Chroma | MmapVectorStore): store to write to
+        embeddings (BatchedOllamaEmbeddings | TeiEmbeddings): embeddings client from getEmbeddings
+        dimension (int): size of the vectors the model returns
+        texts (list[str]): chunk texts
+        metadatas (list[dict]): metadata of each chunk
+        ids (list[str]): stable id of each chunk
+    """
+    existing = existingChunkIds(vectorStore, ids)
+    if existing:
+        unseen = [i for i, chunk in enumerate(ids) if chunk not in existing]
+        texts = [texts[i] for i in unseen]
+        metadatas = [metadatas[i] for i in unseen]
+        ids = [ids[i] for i in unseen]
+    if not ids:
+        return 0
+
+    vectors = embeddings.embedArray(texts, dimension)
+    if isinstance(vectorStore, MmapVectorStore):
+        vectorStore.add(ids, vectors, texts, metadatas)  # quantizes on its own
+        return len(ids)
+    vectorStore._collection.upsert(ids=ids, embeddings=vectors, documents=texts, metadatas=metadatas)
+    return len(ids)
+
+def runIngestPipeline(config: Config, paths: list[str], splitDocuments, embeddings: BatchedOllamaEmbeddings | TeiEmbeddings, dimension: int, vectorStore: Chroma | MmapVectorStore) -> tuple[int, int, dict]:
+    """
+    Helper function to load, split and embed files as three overlapping stages
+
+    Loading and splitting each run on their own thread and hand work on through queues of
+    config.pipelineQueueSize, while embedding and writing runs on the calling thread. The GPU keeps
+    embedding while the CPU loads and splits, and only a few queues' worth of documents and
+    chunks are in memory at once. A chunk whose id was already queued this run isn't queued
+    again. Returns the number of documents ingested, the number of chunks embedded, and the
+    ids of the chunks each file uses (embedded now or already stored).
+
+    Args:
+        config (Config): settings for this run
+        paths (list[str]): markdown files to ingest
+        splitDocuments (callable): takes a list of Documents, returns the chunk texts of each
+        embeddings (BatchedOllamaEmbeddings | TeiEmbeddings): embeddings client from getEmbeddings
+        dimension (int): size of the vectors the model returns
+        vectorStore (Chroma | MmapVectorStore): store to write to
+    """
+    queueSize = config.pipelineQueueSize
+    batchSize = config.writeBatchSize
+    documentQueue = queue.Queue(maxsize=queueSize)
+    chunkQueue = queue.Queue(maxsize=queueSize)
+    stopEvent = threading.Event()
+    errors = []
+    loadProgress = tqdm(total=len(paths), desc="Loading markdown", unit="file", position=0)
+    splitProgress = tqdm(total=len(paths), desc="Splitting", unit="file", position=1)
+    embedProgress = tqdm(desc="Embedding chunks", unit="chunk", position=2)
+
+    def loadStage():
+        # Submit one queue's worth of files at a time, executor.map would otherwise read the
+        # whole vault into memory ahead of the splitter
+        with ProcessPoolExecutor() as executor:
+            for i in range(0, len(paths), queueSize):
+                for doc in executor.map(loadMarkdown, paths[i:i + queueSize]):
+                    if not putUnlessStopped(documentQueue, doc, stopEvent):
+                        return
+                    loadProgress.update(1)
+
+    skippedChunks = 0
+    seenIds = set()
+    chunkIdsBySource = {}
+
+    def splitStage():
+        nonlocal skippedChunks
+        done = False
+        while not done:
+            # Split whatever has queued up together, so the tokenizer still sees batches
+            docs = []
+            item = getUnlessStopped(documentQueue, stopEvent)
+            while item is not PIPELINE_DONE:
+                docs.append(item)
+                if documentQueue.empty() or len(docs) >= queueSize:
+                    break
+                item = documentQueue.get()
+            done = item is PIPELINE_DONE
+            for doc, chunks in zip(docs, splitDocuments(docs) if docs else []):
+                kept = [(chunkId(text), text) for text in filterChunks(chunks, config.minChunkChars)]
+                chunkIdsBySource[doc.metadata["source"]] = list(dict.fromkeys(chunk for chunk, _ in kept))
+                # Repeated chunks (in this note or one split earlier this run) only need one row
+                newRows = []
+                for chunk, text in kept:
+                    if chunk not in seenIds:
+                        seenIds.add(chunk)
+                        newRows.append((chunk, text))
+                skippedChunks += len(chunks) - len(newRows)
+                split = (
+                    [text for _, text in newRows],
+                    [doc.metadata] * len(newRows),
+                    [chunk for chunk, _ in newRows]
+                )
+                if not putUnlessStopped(chunkQueue, split, stopEvent):
+                    return
+                splitProgress.update(1)
+
+    threads = [
+        threading.Thread(target=runStage, args=(loadStage, documentQueue, stopEvent, errors), daemon=True),
+        threading.Thread(target=runStage, args=(splitStage, chunkQueue, stopEvent, errors), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    # Embed and write on this thread, config.writeBatchSize chunks at a time
+    documentCount, chunkCount = 0, 0
+    texts, metadatas, ids = [], [], []
+    try:
+        while True:
+            item = getUnlessStopped(chunkQueue, stopEvent)
+            if item is not PIPELINE_DONE:
+                documentCount += 1
+                texts.extend(item[0])
+                metadatas.extend(item[1])
+                ids.extend(item[2])
+            while len(texts) >= batchSize or (item is PIPELINE_DONE and texts):
+                chunkCount += writeBatch(vectorStore, embeddings, dimension, texts[:batchSize], metadatas[:batchSize], ids[:batchSize])
+                written = min(len(texts), batchSize)
+                del texts[:written], metadatas[:written], ids[:written]
+                embedProgress.update(written)
+            if item is PIPELINE_DONE:
+                break
+    except BaseException:
+        stopEvent.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+        for progress in (loadProgress, splitProgress, embedProgress):
+            progress.close()
+
+    if errors:
+        raise errors[0]
+    print(f"Skipped {skippedChunks} chunks that were under {config.minChunkChars} characters or repeated")
+    print(f"Reused {len(seenIds) - chunkCount} chunks that were already in the vector store")
+    return documentCount, chunkCount, chunkIdsBySource
 
 """
 Main method, used to injest the contents of a directory.
@@ -70,47 +796,34 @@ def main():
     # start a timer
     startTime = time.time()
 
+    # Load settings from the .env
+    config = Config.load()
+
     # Print loaded environment data from .env
     print("\n=== Environment Data ===")
-    print(f"\tVault path: {VAULT_PATH}")
-    print(f"\tChroma DB Path: {CHROMA_PATH}")
-    print(f"\tEmbedding Model ID: {EMBEDDING_MODEL}")
+    print(f"\tVault path: {config.vaultPath}")
+    print(f"\tChroma DB Path: {config.chromaPath}")
+    print(f"\tEmbedding Backend: {config.embeddingBackend}")
+    print(f"\tEmbedding Model ID: {config.embeddingModel}")
     print("=== End Environment Data ===\n")
 
     # Validate path to the obsidian vault
-    if not os.path.exists(VAULT_PATH):
-        print(f"Error: Vault path is invalid. Loaded path: {VAULT_PATH}")
+    if not os.path.exists(config.vaultPath):
+        print(f"Error: Vault path is invalid. Loaded path: {config.vaultPath}")
         return
     else:
-        print(f"Validated vault path {VAULT_PATH}, proceeding to load all md files")
-
-    printDirectory(path=VAULT_PATH, printOnlyMd=True)
-
-    # Use a directory loaded to load all markdown files
-    loader = DirectoryLoader(
-        path=VAULT_PATH,
-        glob="**/*.md",
-        loader_cls=UnstructuredMarkdownLoader,
-        show_progress=True,
-        use_multithreading=False,
-        silent_errors=False
-    )
-    documents = loader.load() # load documents into documents variable
-    if not documents:
+        print(f"Validated vault path {config.vaultPath}, proceeding to load all md files")
+
+    # Walk the vault once, the same list of paths is used for the manifest and for loading
+    mdPaths = printDirectory(path=config.vaultPath, printOnlyMd=True)
+
+    # Compare the vault with the manifest from the last run so only new or edited notes get re-embedded
+    manifestPath = os.path.join(config.chromaPath, MANIFEST_NAME)
+    previousManifest = loadManifest(manifestPath)
+    if not mdPaths and not previousManifest:
         print(f"Failed to load documents, no markdown files in vault")
         return
-    else:
-        print(f"Succesfully loaded {len(documents)} documents")
-
-    # Now split data into chunks before feeding it to our model
-    print(f"Splitting documents into chunks")
-    textSplitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len
-    )
-    chunks = textSplitter.split_documents(documents=documents)
-    print(f"Split {len(documents)} documents into {len(chunks)} chunks")
+    # An emptied vault still falls through, so the chunks of its last notes get deleted
 
     # initialize the model and pass it the chunk data
     '''
@@ -120,21 +833,103 @@ def main():
     It is a translator and it communicates with local Ollama server and converts test -> numbers
     The model processes the meaning and returns a data vector [00, 00, ... ,00] 
     
-    Apparently, some models don't support embedding! 
-    -> qwen3:30b supports this
-    -> magistral:latest -> chromadb.errors.InvalidArgumentError: Collection expecting embedding with dimension of 2048, got 5120
+    Use a model built for embedding, not a chat model!
+    -> nomic-embed-text (768 dims), all-minilm (384 dims), mxbai-embed-large (1024 dims)
+    -> chat models like qwen3:30b (2048 dims) or magistral (5120 dims) work, but are far slower
+       and make the chroma index several times bigger
+    -> every chunk in a collection must have the same dimension, switching models rebuilds the store
+       (the manifest records the model and dimension, see manifestSettings)
     '''
-    print(f"Initializing embedding model: {EMBEDDING_MODEL}")
-    embeddings = OllamaEmbeddings(model=EMBEDDING_MODEL)
-    print(f"Initialized embedding model: {EMBEDDING_MODEL}")
-
-    # Use embeddings with Chromadb to generate vector store
-    print(f"Creating and persisting vector store at: {CHROMA_PATH}")
-    Chroma.from_documents(
-        documents=chunks,
-        embedding=embeddings,
-        persist_directory=CHROMA_PATH
-    )
+    print(f"Initializing {config.embeddingBackend} embeddings")
+    embeddings = getEmbeddings(config)
+    try:
+        if config.embeddingBackend == "tei":
+            print(f"Initialized TEI embeddings at {config.teiBaseUrl} (batch size {config.embedBatchSize}, {config.numParallel} parallel requests)")
+        else:
+            print(f"Initialized embedding model: {config.embeddingModel} (batch size {config.embedBatchSize}, {config.numParallel} parallel requests)")
+
+        # A manifest from another backend, quantization or model doesn't describe this store, so start over.
+        # Asking for the model id doesn't load the model, so an up to date vault still returns quickly.
+        settings = manifestSettings(config, embeddings.modelId())
+        previousSettings = previousManifest.get("settings", {})
+        rebuild = bool(previousManifest) and any(previousSettings.get(key) != value for key, value in settings.items())
+        if rebuild:
+            print(f"Store settings changed since the last ingest ({previousSettings} -> {settings}), "
+                  f"re-ingesting the whole vault")
+        previousFiles = {} if rebuild else previousManifest.get("files", {})
+        changedPaths, deletedPaths, files = diffVault(mdPaths, previousFiles)
+        print(f"Found {len(changedPaths)} new or changed and {len(deletedPaths)} deleted markdown files "
+              f"({len(mdPaths) - len(changedPaths)} unchanged)")
+        if not changedPaths and not deletedPaths:
+            saveManifest(manifestPath, {"settings": {**settings, "dimension": previousSettings.get("dimension")}, "files": files})
+            print(f"Vector store at '{config.chromaPath}' is already up to date, nothing to ingest")
+            return
+
+        # Ollama only loads a model on its first request, which can take 5-30s. Make that happen here,
+        # timed on its own, instead of stalling the first write batch. Every request also sends
+        # OLLAMA_KEEP_ALIVE so the model stays loaded for the rest of the ingest.
+        warmupStart = time.time()
+        dimension = checkEmbeddingDimension(embeddings)
+        warmupDuration = time.time() - warmupStart
+        print(f"Embedding model warmed up in {warmupDuration:.2f}s")
+
+        # Same model name but a different vector size (e.g. a re-pulled tag) also means starting over
+        if previousManifest and not rebuild and previousSettings.get("dimension") != dimension:
+            print(f"Embedding dimension changed since the last ingest ({previousSettings.get('dimension')} -> {dimension}), "
+                  f"re-ingesting the whole vault")
+            rebuild = True
+            previousFiles = {}
+            changedPaths, deletedPaths, files = diffVault(mdPaths, previousFiles)
+        manifest = {"settings": {**settings, "dimension": dimension}, "files": files}
+
+        if config.vectorBackend == "mmap":
+            # Flat float16 (or int8) matrix instead of chroma's per-row sqlite inserts
+            print(f"Updating memory mapped vector store at: {config.chromaPath}")
+            if rebuild:
+                deleteStore(config.chromaPath)
+            vectorStore = MmapVectorStore(config.chromaPath, dimension, config.quantization)
+        else:
+            # Use embeddings with Chromadb to generate vector store
+            print(f"Updating and persisting vector store at: {config.chromaPath}")
+            vectorStore = Chroma(persist_directory=config.chromaPath, embedding_function=embeddings)
+            if rebuild:
+                vectorStore.delete_collection()
+                vectorStore = Chroma(persist_directory=config.chromaPath, embedding_function=embeddings)
+
+        # Pick how documents get split into chunks
+        if config.chunkTokenizer:
+            print(f"Splitting documents into chunks of {config.chunkTokens} tokens using {config.chunkTokenizer}")
+            tokenizer = loadTokenizer(config.chunkTokenizer)
+            splitDocuments = lambda docs: splitByTokens(docs, tokenizer, config.chunkTokens, config.chunkTokenOverlap)
+        else:
+            # rust splitter, same size/overlap semantics as langchain's recursive splitter
+            # but the split loop runs in compiled code instead of recursing in python
+            print(f"Splitting documents into chunks")
+            textSplitter = TextSplitter(capacity=1000, overlap=200)
+            splitDocuments = lambda docs: [textSplitter.chunks(doc.page_content) for doc in docs]
+
+        # Load only the files that changed, straight from the paths we already have instead of
+        # letting a DirectoryLoader glob the vault again. Loading, splitting and embedding overlap,
+        # see runIngestPipeline. Chunks travel as parallel text/metadata/id lists rather than one
+        # Document each. Ids come from the text of a chunk, so chunks that are already stored
+        # (unchanged parts of an edited note, text repeated across notes, or everything written
+        # before a crash) are skipped instead of embedded again, and re-running never duplicates anything.
+        documentCount, chunkCount, chunkIdsBySource = runIngestPipeline(config, changedPaths, splitDocuments, embeddings, dimension, vectorStore)
+        for path in changedPaths:
+            files[path]["chunks"] = chunkIdsBySource.get(path, [])
+
+        # Only now drop the rows that changed or deleted notes used and no note uses any more,
+        # so an interrupted run still finds what it already wrote
+        candidateIds = {chunk for path in changedPaths + deletedPaths for chunk in previousFiles.get(path, {}).get("chunks", [])}
+        pruneChunks(vectorStore, files, candidateIds)
+        if config.vectorBackend == "mmap":
+            vectorStore.save()
+
+        # Only record the new hashes once the store has them, a failed run gets retried next time
+        saveManifest(manifestPath, manifest)
+    finally:
+        # Close the http client and its event loop, even if the ingest failed
+        embeddings.close()
 
     # Track the end time here
     endTime = time.time()
@@ -142,8 +937,9 @@ def main():
     minutes, seconds = divmod(runDuration, 60)
 
     print(f"Ingestion completed")
-    print(f"Vector store generated at '{CHROMA_PATH}'. You can now query your vault.")
-    print(f"Injested documents: {len(documents)}, chunks: {len(chunks)} in time {int(minutes)}:{seconds:.2f}")
+    print(f"Vector store generated at '{config.chromaPath}'. You can now query your vault.")
+    print(f"Injested documents: {documentCount}, chunks embedded: {chunkCount} in time {int(minutes)}:{seconds:.2f} "
+          f"(of which {warmupDuration:.2f}s model warmup)")
 
 if __name__ == "__main__":
     main() # run main
\ No newline at end of file
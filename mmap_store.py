@@ -0,0 +1,303 @@
+import os
+import json
+import numpy as np
+
+# Rows copied or scored per step, keeps memory flat no matter how big the store gets
+BLOCK_ROWS = 65536
+
+def quantizeInt8(vectors) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Helper function to quantize vectors to int8 with one symmetric scale per vector
+
+    Each vector is divided by max(|v|) / 127 and rounded, so vector ~= codes * scale.
+    Cosine similarity between the codes stays within about 1% of the original.
+
+    Args:
+        vectors (array-like): (n, dim) float vectors
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1  # all-zero vector, any scale works
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+def dequantizeInt8(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    """
+    Helper function to turn int8 codes from quantizeInt8 back into float32 vectors
+
+    Args:
+        codes (np.ndarray): (n, dim) int8 codes
+        scales (np.ndarray): (n,) scale of each vector
+    """
+    return codes.astype(np.float32) * scales[:, None]
+
+# Prefixes of every file a store keeps in its directory, see MmapVectorStore
+STORE_PREFIXES = ("vectors.", "scales.", "records.", "offsets.", "ids.", "store.json")
+
+def deleteStore(path: str):
+    """
+    Helper function to delete the mmap store files in path, including leftovers of an unfinished save
+
+    Other files in the directory (chroma's database, the ingest manifest) are left alone.
+
+    Args:
+        path (str): directory holding the store
+    """
+    if not os.path.isdir(path):
+        return
+    for name in os.listdir(path):
+        if name.startswith(STORE_PREFIXES):
+            os.remove(os.path.join(path, name))
+
+class MmapVectorStore:
+    """
+    Vector store kept as one flat matrix on disk plus a JSON lines file of ids, texts and metadata
+
+    Vectors are unit normalized and stored as float16, or as int8 codes with a float32 scale per
+    row when quantization is "int8". Row i of the matrix belongs to line i of the records file,
+    whose byte offsets are kept in a uint64 array next to it, and the ids alone are kept in their
+    own file. The matrix and offsets are memory mapped, so opening the store costs nothing, a query
+    is a blocked matrix-vector product, and only the k records it returns are read.
+
+    New rows are appended to side files and merged with the surviving old rows on save(). Every
+    save writes a new generation of files and only then points store.json at it (an atomic
+    replace), so a run or a save that dies halfway leaves the previous store untouched.
+    """
+
+    def __init__(self, path: str, dimension: int, quantization: str = "none"):
+        self.path = path
+        self.dimension = dimension
+        self.quantization = quantization
+        self.dtype = np.int8 if quantization == "int8" else np.float16
+        self.infoFile = os.path.join(path, "store.json")
+
+        self.count = 0
+        self.generation = 0
+        if os.path.exists(self.infoFile):
+            with open(self.infoFile, "r", encoding="utf-8") as f:
+                info = json.load(f)
+            if info["dimension"] != dimension or info["quantization"] != quantization or "generation" not in info:
+                raise ValueError(
+                    f"Error. Store at {path} holds {info['dimension']} dim vectors with quantization "
+                    f"'{info['quantization']}' in {'an older' if 'generation' not in info else 'this'} format, "
+                    f"expected {dimension} and '{quantization}'. Delete it to rebuild."
+                )
+            self.count = info["count"]
+            self.generation = info["generation"]
+
+        self._storedIds = None
+        self._dropIds = set()
+        self._newMetadata = {}
+        self._newCount = 0
+
+    def _files(self, generation: int) -> dict:
+        # Paths of one generation of store files
+        vectorSuffix = "int8" if self.quantization == "int8" else "fp16"
+        return {
+            "vectors": os.path.join(self.path, f"vectors.{generation}.{vectorSuffix}"),
+            "scales": os.path.join(self.path, f"scales.{generation}.f32"),
+            "records": os.path.join(self.path, f"records.{generation}.jsonl"),
+            "offsets": os.path.join(self.path, f"offsets.{generation}.u64"),
+            "ids": os.path.join(self.path, f"ids.{generation}.txt")
+        }
+
+    def _newFiles(self) -> dict:
+        # Side files add() appends to until the next save()
+        return {
+            "vectors": os.path.join(self.path, "vectors.new"),
+            "scales": os.path.join(self.path, "scales.new"),
+            "records": os.path.join(self.path, "records.new")
+        }
+
+    def existingIds(self, ids: list[str]) -> set:
+        """
+        Return which of these ids are already stored, only the ids file is read
+
+        Args:
+            ids (list[str]): ids to look up
+        """
+        if self._storedIds is None:
+            self._storedIds = set()
+            if self.count:
+                with open(self._files(self.generation)["ids"], "r", encoding="utf-8") as f:
+                    self._storedIds = {line.rstrip("\n") for line in f}
+        return self._storedIds.intersection(ids)
+
+    def deleteIds(self, ids):
+        """
+        Drop the stored rows with these ids on the next save()
+
+        Args:
+            ids (iterable[str]): ids to drop
+        """
+        self._dropIds.update(ids)
+
+    def updateMetadata(self, metadatas: dict):
+        """
+        Replace the metadata of stored rows on the next save()
+
+        Args:
+            metadatas (dict): {id: new metadata}
+        """
+        self._newMetadata.update(metadatas)
+
+    def add(self, ids: list[str], vectors, texts: list[str], metadatas: list[dict]):
+        """
+        Append a batch of vectors with their ids, texts and metadata, written on the next save()
+
+        Args:
+            ids (list[str]): id of each row
+            vectors (array-like): (n, dimension) float vectors
+            texts (list[str]): text of each row
+            metadatas (list[dict]): metadata of each row
+        """
+        newFiles = self._newFiles()
+        if self._newCount == 0:
+            os.makedirs(self.path, exist_ok=True)
+            for path in newFiles.values():
+                open(path, "wb").close()
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        with open(newFiles["vectors"], "ab") as f:
+            if self.quantization == "int8":
+                codes, scales = quantizeInt8(vectors)
+                f.write(codes.tobytes())
+                with open(newFiles["scales"], "ab") as scaleOut:
+                    scaleOut.write(scales.tobytes())
+            else:
+                f.write(vectors.astype(np.float16).tobytes())
+        with open(newFiles["records"], "a", encoding="utf-8") as f:
+            for rowId, text, metadata in zip(ids, texts, metadatas):
+                f.write(json.dumps({"id": rowId, "text": text, "metadata": metadata}) + "\n")
+        self._newCount += len(ids)
+
+    def _copyRows(self, files: dict, count: int, outputs: dict, position: int) -> tuple[int, int]:
+        # Copy the rows of one set of files that aren't dropped, a block at a time, applying any
+        # metadata updates. Returns the number of rows kept and the byte position reached in the
+        # output records. Ids come from the ids file when there is one, only updated rows are parsed.
+        if count == 0:
+            return 0, position
+        vectors = np.memmap(files["vectors"], dtype=self.dtype, mode="r", shape=(count, self.dimension))
+        scales = None
+        if self.quantization == "int8":
+            scales = np.memmap(files["scales"], dtype=np.float32, mode="r", shape=(count,))
+        idsIn = open(files["ids"], "r", encoding="utf-8") if "ids" in files else None
+        kept = 0
+        try:
+            with open(files["records"], "rb") as records:
+                for start in range(0, count, BLOCK_ROWS):
+                    lines = [records.readline() for _ in range(min(BLOCK_ROWS, count - start))]
+                    if idsIn is not None:
+                        rowIds = [idsIn.readline().rstrip("\n") for _ in lines]
+                    else:
+                        rowIds = [json.loads(line)["id"] for line in lines]
+                    keep = np.array([rowId not in self._dropIds for rowId in rowIds], dtype=bool)
+                    outputs["vectors"].write(np.ascontiguousarray(vectors[start:start + len(lines)][keep]).tobytes())
+                    if scales is not None:
+                        outputs["scales"].write(np.ascontiguousarray(scales[start:start + len(lines)][keep]).tobytes())
+                    ends = []
+                    for line, rowId, keepLine in zip(lines, rowIds, keep):
+                        if not keepLine:
+                            continue
+                        if rowId in self._newMetadata:
+                            record = json.loads(line)
+                            record["metadata"] = self._newMetadata[rowId]
+                            line = (json.dumps(record) + "\n").encode("utf-8")
+                        outputs["records"].write(line)
+                        outputs["ids"].write(rowId + "\n")
+                        position += len(line)
+                        ends.append(position)
+                    outputs["offsets"].write(np.array(ends, dtype=np.uint64).tobytes())
+                    kept += int(keep.sum())
+        finally:
+            if idsIn is not None:
+                idsIn.close()
+        del vectors, scales  # release the maps before the files get removed
+        return kept, position
+
+    def save(self):
+        """
+        Merge the surviving old rows and the newly added rows into a new generation of store files
+        """
+        if self._newCount == 0 and not self._dropIds and not self._newMetadata:
+            return
+        os.makedirs(self.path, exist_ok=True)
+
+        oldFiles = self._files(self.generation)
+        files = self._files(self.generation + 1)
+        outputs = {name: open(path, "wb") for name, path in files.items()}
+        outputs["ids"].close()
+        outputs["ids"] = open(files["ids"], "w", encoding="utf-8")
+        try:
+            outputs["offsets"].write(np.zeros(1, dtype=np.uint64).tobytes())  # offsets has count + 1 entries
+            count, position = self._copyRows(oldFiles, self.count, outputs, 0)
+            newCount, position = self._copyRows(self._newFiles(), self._newCount, outputs, position)
+            count += newCount
+        finally:
+            for output in outputs.values():
+                output.close()
+
+        # Switching store.json over is what commits the new generation
+        with open(self.infoFile + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"dimension": self.dimension, "quantization": self.quantization,
+                       "count": count, "generation": self.generation + 1}, f)
+        os.replace(self.infoFile + ".tmp", self.infoFile)
+
+        for path in list(oldFiles.values()) + list(self._newFiles().values()):
+            if os.path.exists(path):
+                os.remove(path)
+        if self.quantization != "int8":
+            os.remove(files["scales"])
+        self.count = count
+        self.generation += 1
+        self._storedIds = None
+        self._dropIds = set()
+        self._newMetadata = {}
+        self._newCount = 0
+
+    def _openRows(self):
+        # memory map the matrix (and scales), nothing is read until rows are touched
+        files = self._files(self.generation)
+        vectors = np.memmap(files["vectors"], dtype=self.dtype, mode="r", shape=(self.count, self.dimension))
+        scales = None
+        if self.quantization == "int8":
+            scales = np.memmap(files["scales"], dtype=np.float32, mode="r", shape=(self.count,))
+        return vectors, scales
+
+    def search(self, queryVector, k: int = 10) -> list[tuple[float, dict]]:
+        """
+        Find the k rows most similar to a query vector, returns (cosine similarity, record) pairs
+
+        Args:
+            queryVector (array-like): embedding of the query
+            k (int): number of results
+        """
+        if self.count == 0:
+            return []
+        query = np.asarray(queryVector, dtype=np.float32)
+        query = query / max(np.linalg.norm(query), 1e-12)
+
+        # Score a block at a time in float32 so numpy hands the product to BLAS
+        vectors, scales = self._openRows()
+        sims = np.empty(self.count, dtype=np.float32)
+        for start in range(0, self.count, BLOCK_ROWS):
+            block = vectors[start:start + BLOCK_ROWS].astype(np.float32) @ query
+            if scales is not None:
+                block *= scales[start:start + BLOCK_ROWS]
+            sims[start:start + BLOCK_ROWS] = block
+
+        k = min(k, self.count)
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top])]
+
+        # Only read the k records that are returned, found through the offsets array
+        files = self._files(self.generation)
+        offsets = np.memmap(files["offsets"], dtype=np.uint64, mode="r", shape=(self.count + 1,))
+        results = []
+        with open(files["records"], "rb") as records:
+            for i in top:
+                records.seek(int(offsets[i]))
+                record = json.loads(records.read(int(offsets[i + 1] - offsets[i])))
+                results.append((float(sims[i]), record))
+        return results
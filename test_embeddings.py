@@ -24,18 +24,19 @@ def main():
         # 3. Generate the embedding
         # This is the line that actually communicates with Ollama
         print("3. Calling the embed_query() method... (This may take a moment)")
-        vector = embeddings.embed_query(test_text)
+        # Convert to a float32 array once, everything below works on contiguous memory
+        vector = np.asarray(embeddings.embed_query(test_text), dtype=np.float32)
         print("   - Success: Communication with Ollama was successful!")
 
         # 4. Visualize the output
         print("\n4. Analyzing the received embedding vector...")
         
-        # Check if the output is a list of numbers (floats)
-        is_list_of_floats = all(isinstance(item, float) for item in vector)
+        # Check if the output is a flat array of numbers (floats)
+        is_float_vector = vector.ndim == 1 and vector.dtype == np.float32
         
-        print(f"   - Type of output: {type(vector)}")
-        print(f"   - Is it a list of numbers? {'Yes' if is_list_of_floats else 'No'}")
-        print(f"   - Number of dimensions (vector length): {len(vector)}")
+        print(f"   - Type of output: {type(vector)} ({vector.dtype})")
+        print(f"   - Is it a vector of numbers? {'Yes' if is_float_vector else 'No'}")
+        print(f"   - Number of dimensions (vector length): {vector.shape[0]}")
         
         # Print a small sample of the vector
         print(f"   - First 5 dimensions: {np.round(vector[:5], 3)}")